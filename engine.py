@@ -4,14 +4,53 @@ A SilhouetteFX engine for Tank.
 """
 
 import sgtk
-import copy
+import errno
+import hashlib
 import os
 import logging
-import shutil
+import re
 
 from sgtk.platform import Engine
 from sgtk import TankError
 
+# single module holding the silhouette actions for all the commands
+_ACTIONS_MODULE_NAME = "tk_silhouette_actions.py"
+# action class names are prefixed so they can't shadow the names the module uses
+_ACTION_CLASS_PREFIX = "tk_silhouette_action_"
+_NON_IDENTIFIER_RE = re.compile(r"[^0-9A-Za-z_]")
+# source of the actions module, see SilhouetteEngine.__write_silhouette_actions()
+_ACTIONS_MODULE_TEMPLATE = """\
+import sgtk
+from fx import Action, addAction
+{actions}for action_class in [{action_classes}]:
+   addAction(action_class())
+"""
+# source of a silhouette action which will be enabled if the given command is part
+# of the current engine's commands attribute and will call the command callback
+# in the execute method
+_ACTION_TEMPLATE = """\
+class {short_name}(Action):
+   def __init__(self):
+       self.sgtk_engine_command_name = {display_name!r}
+       Action.__init__(self, self.sgtk_engine_command_name, root='Shotgun')
+   def available(self):
+       current_engine = sgtk.platform.current_engine()
+       assert current_engine, 'No engine running'
+       assert self.sgtk_engine_command_name in current_engine.commands, 'Command not available in current environment'
+   def execute(self):
+       current_engine = sgtk.platform.current_engine()
+       current_engine.commands[self.sgtk_engine_command_name]['callback']()
+"""
+# sidecar file holding a hash of the actions the module was written for
+_ACTIONS_MANIFEST_NAME = ".manifest"
+
+# buffer size for the generated files, large enough to write each in one go
+_WRITE_BUFFER_SIZE = 65536
+
+# environment names per pipeline configuration path, these don't change
+# for the lifetime of the process
+_ENVIRONMENT_NAMES = {}
+
 class SilhouetteEngine(Engine):
     @property
     def context_change_allowed(self):
@@ -39,96 +78,71 @@ class SilhouetteEngine(Engine):
             self.utils_module = tk_silhouette.utils
         return self.utils_module
 
+    def init_engine(self):
+        # whether environment files mention this engine keyed by name, see _get_engine_env()
+        self._env_cache = {}
 
     def create_shotgun_menu(self):
         if self.has_ui:
+            # Get temp folder path, it is created below if needed.
+            self.custom_scripts_dir_path = os.environ['TK_SILHOUETTE_MENU_DIR']
+
             # get all environments
-            pc = self.sgtk.pipeline_configuration
-            env_names_to_process = pc.get_environments()
+            env_names_to_process = self._get_environment_names()
             # current env app commands will already be available in engine.commands
             env_names_to_process.remove(self.env.name)
             commands_to_write = {}
 
             # collect commands registered by apps from all environments
             for env_name in env_names_to_process:
-                env_obj = pc.get_environment(env_name, writable=True)
+                env_obj = self._get_engine_env(env_name)
 
-                if self.name in env_obj.get_engines():
-                    # reusing generous chunks of engine.__load_apps()
+                if env_obj and self.name in env_obj.get_engines():
                     app_names_to_process = env_obj.get_apps(self.instance_name)
                     for app_instance_name in app_names_to_process:
+                        # we have already initialised some apps
+                        if app_instance_name in self.apps:
+                            continue
+
                         app_descriptor = env_obj.get_app_descriptor(self.instance_name, app_instance_name)
                         app_path = app_descriptor.get_path()
 
-                        # we have already initialised some apps
-                        if not app_instance_name in self.apps:
-                            old_command_keys = copy.deepcopy(self.commands.keys())
-                            try:
-                                app_obj = sgtk.platform.engine.load_application(self, self.context,
-                                                                                env_obj, app_instance_name)
-
-                            except TankError as e:
-                                # validation error - probably some issue with the settings!
-                                # report this as an error message.
-                                self.log_error(
-                                    "App configuration Error for %s (configured in environment '%s'). "
-                                    "It will not be loaded: %s" % (
-                                    app_instance_name, env_obj.disk_location, e))
-                                continue
-
-                            except Exception:
-                                # code execution error in the validation. Report this as an error
-                                # with the engire call stack!
-                                self.log_exception("A general exception was caught while trying to "
-                                                   "load the application %s located at '%s'. "
-                                                   "The app will not be loaded." % (
-                                                   app_instance_name, env_obj.disk_location))
-                                continue
-
-                                # initialize the app
-
-                            try:
-                                # track the init of the app
-                                self.__currently_initializing_app = app_obj
-                                try:
-                                    app_obj.init_app()
-                                finally:
-                                    self.__currently_initializing_app = None
-
-                            except TankError as e:
-                                self.log_error(
-                                    "App %s failed to initialize. It will not be loaded: %s" % (
-                                    app_path, e))
-
-                            except Exception:
-                                self.log_exception(
-                                    "App %s failed to initialize. It will not be loaded." % app_path)
-
-                            finally:
-                                # clean up commands and add the new commands to silhouette actions
-                                # TODO: is this all?
-                                new_command_names = set(self.commands.keys()) - set(old_command_keys)
-                                for new_command_name in new_command_names:
-                                    commands_to_write[new_command_name] = self.commands[new_command_name]
-                                    self.commands.pop(new_command_name)
-                                app_obj.destroy_app()
+                        # Apps register their commands in init_app() depending on the
+                        # context, so they have to be loaded for each menu build.
+                        app_commands = self.__load_app_commands(env_obj, app_instance_name, app_path)
+                        if app_commands is None:
+                            continue
+
+                        for command_name, short_name in app_commands.items():
+                            commands_to_write[command_name] = {"properties": {"short_name": short_name}}
 
             commands_to_write.update(self.commands)
 
-            # Get temp folder path and create it if needed.
-            self.custom_scripts_dir_path = os.environ['TK_SILHOUETTE_MENU_DIR']
-            sgtk.util.filesystem.ensure_folder_exists(self.custom_scripts_dir_path)
+            actions = self.__get_action_class_names(commands_to_write)
 
-            # Clear it.
-            for item in os.listdir(self.custom_scripts_dir_path):
-                os.remove(os.path.join(self.custom_scripts_dir_path, item))
+            # Only write the actions again if the commands changed since they
+            # were last written, possibly by a previous session.
+            manifest = self.__hash_actions(actions)
+            script_path = os.path.join(self.custom_scripts_dir_path, _ACTIONS_MODULE_NAME)
+            if manifest == self.__read_actions_manifest() and os.path.isfile(script_path):
+                self.logger.debug("Commands unchanged, not writing actions again")
+                return True
 
-            # Write a file for each action
-            for i, (command_name, command) in enumerate(commands_to_write.iteritems()):
-                action_class_name = command["properties"].get("short_name") or \
-                                    "tk_silhouette_cmd_{}".format(i)
-                self.__write_silhouette_action(command_name, action_class_name)
-                self.logger.debug("Action written for {} {}".format(command_name, command))
+            # Clear it, or create it if it doesn't exist yet.
+            try:
+                stale_items = os.listdir(self.custom_scripts_dir_path)
+            except OSError as error:
+                if error.errno != errno.ENOENT:
+                    raise
+                sgtk.util.filesystem.ensure_folder_exists(self.custom_scripts_dir_path)
+                stale_items = []
+            for item in stale_items:
+                os.unlink(os.path.join(self.custom_scripts_dir_path, item))
+
+            # The manifest goes last so an interrupted write is never taken as up to date
+            self.__write_silhouette_actions(actions)
+            self.__write_actions_manifest(manifest)
+            self.logger.debug("Actions written for {}".format(sorted(actions.values())))
 
             return True
         else:
@@ -150,12 +164,13 @@ class SilhouetteEngine(Engine):
 
     def destroy_engine(self):
         self.logger.debug("%s: Destroying...", self)
+        self._env_cache.clear()
+        if hasattr(self, "utils_module"):
+            self.utils_module.clear_sequence_range_cache()
 
-        try:
-            shutil.rmtree(self.custom_scripts_dir_path)
-        except OSError as error:
-            if error.errno != 2: # Don't error if folder not found.
-                raise
+        # The generated actions are left in the menu folder on purpose, the next
+        # session reuses them if its commands are the same. Stale actions are
+        # disabled by their available() check, even when no engine is running.
 
     @property
     def has_ui(self):
@@ -171,44 +186,214 @@ class SilhouetteEngine(Engine):
     ##########################################################################################
     # logging
 
+    _debug_formatter = logging.Formatter("Debug: Shotgun %(basename)s: %(message)s")
+    _info_formatter = logging.Formatter("Shotgun %(basename)s: %(message)s")
+
     def _emit_log_message(self, handler, record):
         if record.levelno < logging.INFO:
-            formatter = logging.Formatter("Debug: Shotgun %(basename)s: %(message)s")
+            formatter = self._debug_formatter
         else:
-            formatter = logging.Formatter("Shotgun %(basename)s: %(message)s")
+            formatter = self._info_formatter
 
         msg = formatter.format(record)
 
-        print msg
+        print(msg)
+
+    ##########################################################################################
+    # environment helpers
+
+    def _get_environment_names(self):
+        """
+        Return the names of all environments in the pipeline configuration.
+        The config dir is only walked once per process.
+
+        :return: List of environment names, safe to modify
+        """
+        pc = self.sgtk.pipeline_configuration
+        config_path = pc.get_path()
+        if config_path not in _ENVIRONMENT_NAMES:
+            _ENVIRONMENT_NAMES[config_path] = pc.get_environments()
+        return list(_ENVIRONMENT_NAMES[config_path])
+
+    def _get_engine_env(self, env_name):
+        """
+        Return the writable environment object for the given environment.
+
+        Environments are parsed again on every call, as their includes may
+        have changed. Those whose yml file doesn't mention this engine at all
+        are not parsed, as they can't contain any app to load for it. That
+        check is only done again when the yml file changed on disk.
+
+        :param env_name: Name of the environment to get
+        :return:         Environment object or None if it doesn't use this engine
+        """
+        pc = self.sgtk.pipeline_configuration
+        env_path = pc.get_environment_path(env_name)
+        mtime = os.path.getmtime(env_path)
+        cached = self._env_cache.get(env_name)
+        if cached and cached[0] == mtime:
+            uses_engine = cached[1]
+        else:
+            with open(env_path, "rb") as f:
+                env_contents = f.read()
+            uses_engine = self.name.encode("utf-8") in env_contents
+            self._env_cache[env_name] = (mtime, uses_engine)
+
+        if not uses_engine:
+            return None
+        return pc.get_environment(env_name, writable=True)
+
+    def __load_app_commands(self, env_obj, app_instance_name, app_path):
+        """
+        Load and initialize an app from another environment to find out
+        the commands it registers, then destroy it again.
+
+        :param env_obj:           Environment the app is configured in
+        :param app_instance_name: Name of the app instance in the environment
+        :param app_path:          Path to the app on disk
+        :return:                  Dictionary of command names to their short name, or
+                                  None if the app could not be loaded or initialized
+        """
+        # reusing generous chunks of engine.__load_apps()
+        old_command_keys = set(self.commands)
+        try:
+            app_obj = sgtk.platform.engine.load_application(self, self.context,
+                                                            env_obj, app_instance_name)
+
+        except TankError as e:
+            # validation error - probably some issue with the settings!
+            # report this as an error message.
+            self.log_error(
+                "App configuration Error for %s (configured in environment '%s'). "
+                "It will not be loaded: %s" % (
+                app_instance_name, env_obj.disk_location, e))
+            return None
+
+        except Exception:
+            # code execution error in the validation. Report this as an error
+            # with the engire call stack!
+            self.log_exception("A general exception was caught while trying to "
+                               "load the application %s located at '%s'. "
+                               "The app will not be loaded." % (
+                               app_instance_name, env_obj.disk_location))
+            return None
+
+        # initialize the app
+        app_commands = {}
+        initialized = False
+        try:
+            # track the init of the app
+            self.__currently_initializing_app = app_obj
+            try:
+                app_obj.init_app()
+            finally:
+                self.__currently_initializing_app = None
+            initialized = True
+
+        except TankError as e:
+            self.log_error(
+                "App %s failed to initialize. It will not be loaded: %s" % (
+                app_path, e))
+
+        except Exception:
+            self.log_exception(
+                "App %s failed to initialize. It will not be loaded." % app_path)
+
+        finally:
+            # clean up commands and keep the new ones for silhouette actions
+            # TODO: is this all?
+            new_command_names = set(self.commands) - old_command_keys
+            for new_command_name in new_command_names:
+                command = self.commands.pop(new_command_name)
+                app_commands[new_command_name] = command["properties"].get("short_name")
+            app_obj.destroy_app()
+
+        if not initialized:
+            # the failure may well be transient, don't let it be cached
+            return None
+        return app_commands
 
     ##########################################################################################
     # silhouette specific functions
 
-    def __write_silhouette_action(self, command_name, action_class):
-        """
-        Write a silhouette action which will be enabled
-        if the given command is part of the current engine's commands attribute
-        and will call the command callback in the execute method
-
-        :param command_name:
-        :param command:
-
-        """
-        script_path = os.path.join(self.custom_scripts_dir_path, "{}.py".format(action_class))
-        f = open(script_path, "w")
-        f.write("\n".join([
-            "import sgtk",
-            "from fx import Action, addAction",
-            "class {short_name}(Action):".format(short_name=action_class),
-            "   def __init__(self):",
-            "       self.sgtk_engine_command_name = '{display_name}'".format(display_name=command_name),
-            "       Action.__init__(self, self.sgtk_engine_command_name, root='Shotgun')",
-            "   def available(self):",
-            "       current_engine = sgtk.platform.current_engine()",
-            "       assert self.sgtk_engine_command_name in current_engine.commands, 'Command not available in current environment'",
-            "   def execute(self):",
-            "       current_engine = sgtk.platform.current_engine()",
-            "       current_engine.commands[self.sgtk_engine_command_name]['callback']()",
-            "addAction({short_name}())".format(short_name=action_class),
-        ]))
-        f.close()
+    def __write_silhouette_actions(self, actions):
+        """
+        Write a single module defining and adding the silhouette actions
+        for all the given commands
+
+        :param actions: Dictionary of action class names to command names
+        """
+        action_class_names = sorted(actions)
+        source = _ACTIONS_MODULE_TEMPLATE.format(
+            actions="".join(
+                _ACTION_TEMPLATE.format(short_name=action_class_name,
+                                        display_name=actions[action_class_name])
+                for action_class_name in action_class_names
+            ),
+            action_classes=", ".join(action_class_names),
+        )
+
+        script_path = os.path.join(self.custom_scripts_dir_path, _ACTIONS_MODULE_NAME)
+        with open(script_path, "w", buffering=_WRITE_BUFFER_SIZE) as f:
+            f.write(source)
+
+    def __get_action_class_names(self, commands):
+        """
+        Pick a unique and valid python class name for the action of each command,
+        based on its short name
+
+        :param commands: Dictionary of commands keyed by name
+        :return:         Dictionary of action class names to command names
+        """
+        actions = {}
+        for i, (command_name, command) in enumerate(sorted(commands.items())):
+            short_name = command["properties"].get("short_name") or "cmd_{}".format(i)
+            base_class_name = _ACTION_CLASS_PREFIX + _NON_IDENTIFIER_RE.sub("_", short_name)
+            action_class_name = base_class_name
+            suffix = 1
+            while action_class_name in actions:
+                suffix += 1
+                action_class_name = "{}_{}".format(base_class_name, suffix)
+            actions[action_class_name] = command_name
+        return actions
+
+    def __hash_actions(self, actions):
+        """
+        Hash the class and command names of the given actions, which is all
+        the generated module depends on along with its source templates
+
+        :param actions: Dictionary of action class names to command names
+        :return:        Hex digest of the actions
+        """
+        actions_hash = hashlib.sha1()
+        actions_hash.update(_ACTIONS_MODULE_TEMPLATE.encode("utf-8"))
+        actions_hash.update(_ACTION_TEMPLATE.encode("utf-8"))
+        for action_class_name in sorted(actions):
+            actions_hash.update(action_class_name.encode("utf-8"))
+            actions_hash.update(b"\0")
+            actions_hash.update(actions[action_class_name].encode("utf-8"))
+            actions_hash.update(b"\n")
+        return actions_hash.hexdigest()
+
+    def __read_actions_manifest(self):
+        """
+        Read the hash of the actions last written
+
+        :return: Manifest contents or None if there isn't one
+        """
+        manifest_path = os.path.join(self.custom_scripts_dir_path, _ACTIONS_MANIFEST_NAME)
+        try:
+            with open(manifest_path) as f:
+                return f.read()
+        except IOError:
+            return None
+
+    def __write_actions_manifest(self, manifest):
+        """
+        Write the hash of the actions written
+
+        :param manifest: Manifest contents
+        """
+        manifest_path = os.path.join(self.custom_scripts_dir_path, _ACTIONS_MANIFEST_NAME)
+        with open(manifest_path, "w", buffering=_WRITE_BUFFER_SIZE) as f:
+            f.write(manifest)
@@ -1,13 +1,38 @@
 import os
-import glob
 import re
+from collections import defaultdict
 import fx
 
 import sgtk
 from sgtk import TankError
 
 # sources have path format /path/to/file.[start-end].ext
-SILHOUETTE_FRAME_REGEX = "\.\[(\d+)-\d+\]\."
+SILHOUETTE_FRAME_REGEX = r"\.\[(\d+)-\d+\]\."
+_SILHOUETTE_FRAME_RE = re.compile(SILHOUETTE_FRAME_REGEX)
+
+# frame number or frame token at the end of a file root, see sequence_range_from_path
+_FRAME_RE = re.compile(r"([0-9#]+|[%]0\dd)$")
+
+# templates matching paths along with the set of templates they come from,
+# keyed by (tk id, path), see _template_from_path
+_template_cache = {}
+_TEMPLATE_CACHE_SIZE = 1024
+
+# templates grouped by the extension of their definition keyed by tk id,
+# see _fast_template_from_path
+_template_index_cache = {}
+# extensions containing keys or optional sections can match any path
+_NON_LITERAL_EXT_RE = re.compile(r"[\[\]{}]")
+
+# frame spec used to locate the SEQ key in a path built from a template
+_SEQ_PLACEHOLDER = "FORMAT: #"
+_SEQ_PLACEHOLDER_RE = re.compile(r"#+")
+
+# sequence ranges along with the set of templates and the mtime of the folder
+# they come from, keyed by (tk id, template name, fields without SEQ and eye),
+# see find_sequence_range
+_seq_range_cache = {}
+_SEQ_RANGE_CACHE_SIZE = 1024
 
 def seq_path_to_silhouette_format(tk, path):
     """
@@ -22,21 +47,40 @@ def seq_path_to_silhouette_format(tk, path):
     error_message = None
     formatted_path = path
 
-    path_template = tk.template_from_path(path)
+    path_template = _template_from_path(tk, path)
     if path_template:
         path_fields = path_template.get_fields(path)
 
+        frame_range = None
         if "SEQ" in path_fields:
+            frame_range = find_sequence_range(tk, path,
+                                              template=path_template,
+                                              fields=path_fields)
+
+        if frame_range:
             # If we have something to replace, get the frame range string ready
-            start_frame, end_frame = find_sequence_range(tk, path)
+            start_frame, end_frame = frame_range
             frame_range_string = "[{}-{}]".format(start_frame, end_frame)
 
-            # TODO: More secure to create a temporary template with all SEQ keys
-            # replaced with a string key and apply this as value,
-            # to avoid replacing some other key that contains
-            # the default SEQ expression within it
-            replace_value = path_fields["SEQ"]
-            formatted_path = formatted_path.replace(replace_value, frame_range_string)
+            # Replace the SEQ key at the position the template puts it at,
+            # to avoid replacing some other key that contains the default
+            # SEQ expression within it
+            split = _split_on_seq(path_template, path_fields)
+            if split and len(split[0]) + len(split[1]) <= len(path) and \
+                    path.startswith(split[0]) and path.endswith(split[1]):
+                formatted_path = "".join([
+                    path[:len(split[0])],
+                    frame_range_string,
+                    path[len(path) - len(split[1]):],
+                ])
+            else:
+                # The path isn't laid out exactly like the template would
+                # build it, fall back on replacing the SEQ value
+                replace_value = path_fields["SEQ"]
+                formatted_path = formatted_path.replace(replace_value, frame_range_string)
+        elif "SEQ" in path_fields:
+            error_message = "No frames found on disk for path {}. " \
+                            "Not formatting it with frame range.".format(path)
         else:
             error_message = "Path {} fits template {} which has no key called SEQ. " \
                               "Not formatting it with frame range.".format(path, path_template)
@@ -58,27 +102,24 @@ def seq_path_from_silhouette_format(tk, path):
     """
     error_message = None
 
-    compiled_regex = re.compile(SILHOUETTE_FRAME_REGEX)
-    match = compiled_regex.search(path)
+    match = _SILHOUETTE_FRAME_RE.search(path)
     if not match:
         error_message = "No [start-end] found in source path `{}`. " \
                         "Not formatting dependency path.".format(path)
         return path, error_message
 
     first_frame = int(match.group(1))
-    first_frame_path = compiled_regex.sub(".\\g<1>.", path)
+    first_frame_path = _SILHOUETTE_FRAME_RE.sub(".\\g<1>.", path)
 
     # retrieve the template and remove the seq key to replace it with the default
-    path_template = tk.template_from_path(first_frame_path)
+    path_template = _template_from_path(tk, first_frame_path)
     if not path_template:
         error_message = "No template found to match path `{}`. " \
                         "Not formatting dependency path.".format(path)
         return path, error_message
 
     fields = path_template.get_fields(first_frame_path)
-    for key, value in fields.items():
-        if value == first_frame:
-            del fields[key]
+    fields = {key: value for key, value in fields.items() if value != first_frame}
 
     seq_format_path = path_template.apply_fields(fields)
     return seq_format_path, error_message
@@ -121,7 +162,7 @@ def sequence_range_from_path(path):
     :returns: None if no range could be determined, otherwise (min, max)
     :rtype: tuple or None
     """
-    # This pattern will match the following at the end of a string and
+    # _FRAME_RE will match the following at the end of a string and
     # retain the frame number or frame token as group(1) in the resulting
     # match object:
     #
@@ -131,9 +172,8 @@ def sequence_range_from_path(path):
     #
     # The number of digits or hashes does not matter; we match as many as
     # exist.
-    frame_pattern = re.compile(r"([0-9#]+|[%]0\dd)$")
     root, ext = os.path.splitext(path)
-    match = re.search(frame_pattern, root)
+    match = _FRAME_RE.search(root)
 
     # If we did not match, we don't know how to parse the file name, or there
     # is no frame number to extract.
@@ -141,27 +181,35 @@ def sequence_range_from_path(path):
         return None
 
     # We need to get all files that match the pattern from disk so that we
-    # can determine what the min and max frame number is.
-    glob_path = "%s%s" % (
-        re.sub(frame_pattern, "*", root),
-        ext,
-    )
-    files = glob.glob(glob_path)
-
-    # Our pattern from above matches against the file root, so we need
-    # to chop off the extension at the end.
-    file_roots = [os.path.splitext(f)[0] for f in files]
-
-    # We know that the search will result in a match at this point, otherwise
-    # the glob wouldn't have found the file. We can search and pull group 1
-    # to get the integer frame number from the file root name.
-    file_roots.sort()
-    min_frame = re.search(frame_pattern, file_roots[0]).group(1)
-    max_frame = re.search(frame_pattern, file_roots[-1]).group(1)
+    # can determine what the min and max frame number is. These are the files
+    # next to the given one whose name only differs by the frame number.
+    parent, prefix = os.path.split(root[:match.start()])
+    try:
+        names = os.listdir(parent or os.curdir)
+    except OSError:
+        return None
+
+    min_frame = max_frame = None
+    min_value = max_value = None
+    frame_start = len(prefix)
+    for name in names:
+        if not name.startswith(prefix) or not name.endswith(ext):
+            continue
+        frame = name[frame_start:len(name) - len(ext)]
+        if not frame.isdigit():
+            continue
+        value = int(frame)
+        if min_value is None or value < min_value:
+            min_value, min_frame = value, frame
+        if max_value is None or value > max_value:
+            max_value, max_frame = value, frame
+
+    if min_frame is None:
+        return None
     return min_frame, max_frame
 
 
-def find_sequence_range(tk, path):
+def find_sequence_range(tk, path, template=None, fields=None):
     """
     Helper method attempting to extract sequence information.
 
@@ -170,14 +218,17 @@ def find_sequence_range(tk, path):
     attempted to be extracted.
 
     :param path: Path to file on disk.
+    :param template: Template matching the path, looked up if not given.
+    :param fields: Fields extracted from the path by the template,
+                   extracted if not given.
     :returns: None if no range could be determined, otherwise (min, max)
     """
     # find a template that matches the path:
-    template = None
-    try:
-        template = tk.template_from_path(path)
-    except TankError:
-        pass
+    if template is None:
+        try:
+            template = _template_from_path(tk, path)
+        except TankError:
+            pass
 
     if not template:
         # If we don't have a template to take advantage of, then
@@ -186,24 +237,219 @@ def find_sequence_range(tk, path):
         return sequence_range_from_path(path)
 
     # get the fields and find all matching files:
-    fields = template.get_fields(path)
+    if fields is None:
+        fields = template.get_fields(path)
     if "SEQ" not in fields:
         # Ticket #655: older paths match wrong templates,
         # so fall back on path parsing
         return sequence_range_from_path(path)
 
+    key = (
+        id(tk),
+        template.name,
+        frozenset((k, v) for k, v in fields.items() if k not in ("SEQ", "eye")),
+    )
+    # Frames of stereo sequences are spread over several eye folders, while
+    # the folder mtime below is only that of the given path, so don't cache them.
+    if "eye" in template.keys:
+        return _template_sequence_range(tk, template, fields)
+
+    # new frames being written change the folder mtime, invalidating the range
+    try:
+        folder_mtime = os.path.getmtime(os.path.dirname(path))
+    except OSError:
+        folder_mtime = None
+    cached = _seq_range_cache.get(key)
+    # templates may have been reloaded, or the tk id reused since
+    if cached and folder_mtime is not None and \
+            cached[0] is tk.templates and cached[1] == folder_mtime:
+        return cached[2]
+
+    frame_range = _template_sequence_range(tk, template, fields)
+    # don't remember missing sequences, their frames may not be written yet
+    if frame_range is not None and folder_mtime is not None:
+        if len(_seq_range_cache) >= _SEQ_RANGE_CACHE_SIZE:
+            _seq_range_cache.clear()
+        _seq_range_cache[key] = (tk.templates, folder_mtime, frame_range)
+    return frame_range
+
+
+def clear_sequence_range_cache():
+    """
+    Forget the sequence ranges and templates cached by find_sequence_range,
+    so they get resolved again from disk.
+    """
+    _seq_range_cache.clear()
+    _template_cache.clear()
+    _template_index_cache.clear()
+
+
+def _template_sequence_range(tk, template, fields):
+    """
+    Find the range of frames on disk for the sequence described by the
+    given template and fields.
+
+    :param tk:       Tank object
+    :param template: Template with a SEQ key
+    :param fields:   Fields for the template
+    :returns:        None if no frames were found, otherwise (min, max)
+    """
+    seq_key = tk.template_keys["SEQ"]
+
+    # When only the file name varies with SEQ, listing its folder is enough,
+    # without validating every file found against the template.
+    if "eye" not in template.keys:
+        frame_range = _scan_sequence_range(template, fields)
+        if frame_range:
+            return seq_key.str_from_value(frame_range[0]), seq_key.str_from_value(frame_range[1])
+
     files = tk.paths_from_template(template, fields, ["SEQ", "eye"])
 
-    # find frame numbers from these files:
-    frames = []
+    # find the first and last frame numbers from these files:
+    min_frame = max_frame = None
     for file in files:
-        fields = template.get_fields(file)
-        frame = fields.get("SEQ")
-        if frame != None:
-            frames.append(frame)
-    if not frames:
+        file_fields = template.get_fields(file)
+        frame = file_fields.get("SEQ")
+        if frame is None:
+            continue
+        if min_frame is None or frame < min_frame:
+            min_frame = frame
+        if max_frame is None or frame > max_frame:
+            max_frame = frame
+    if min_frame is None:
         return None
 
     # return the padded frame range
-    seq_key = tk.template_keys["SEQ"]
-    return seq_key.str_from_value(min(frames)), seq_key.str_from_value(max(frames))
+    return seq_key.str_from_value(min_frame), seq_key.str_from_value(max_frame)
+
+
+def _split_on_seq(template, fields):
+    """
+    Build the path for the given fields with SEQ as a "####" placeholder
+    and split it around that placeholder.
+
+    :param template: Template with a SEQ key
+    :param fields:   Fields for the template
+    :returns:        None if SEQ could not be located unambiguously, otherwise
+                     (path before SEQ, path after SEQ, placeholder width)
+    """
+    try:
+        placeholder_path = template.apply_fields(dict(fields, SEQ=_SEQ_PLACEHOLDER))
+    except TankError:
+        return None
+
+    spans = [match.span() for match in _SEQ_PLACEHOLDER_RE.finditer(placeholder_path)]
+    if len(spans) != 1:
+        return None
+    start, end = spans[0]
+    return placeholder_path[:start], placeholder_path[end:], end - start
+
+
+def _scan_sequence_range(template, fields):
+    """
+    Find the range of frames of a sequence whose SEQ key is in the file
+    name, by listing its folder once.
+
+    :param template: Template with a SEQ key
+    :param fields:   Fields for the template
+    :returns:        None if no frames were found or SEQ is not in the
+                     file name, otherwise (min, max) frame numbers
+    """
+    split = _split_on_seq(template, fields)
+    if not split:
+        return None
+    head, suffix, width = split
+    if os.sep in suffix or "/" in suffix:
+        return None
+
+    dir_path, prefix = os.path.split(head)
+    try:
+        names = os.listdir(dir_path)
+    except OSError:
+        return None
+
+    min_frame = max_frame = None
+    frame_start = len(prefix)
+    for name in names:
+        if not name.startswith(prefix) or not name.endswith(suffix):
+            continue
+        frame = name[frame_start:len(name) - len(suffix)]
+        if len(frame) < width or not frame.isdigit():
+            continue
+        frame = int(frame)
+        if min_frame is None or frame < min_frame:
+            min_frame = frame
+        if max_frame is None or frame > max_frame:
+            max_frame = frame
+
+    if min_frame is None:
+        return None
+    return min_frame, max_frame
+
+
+def _template_from_path(tk, path):
+    """
+    Cached version of tk.template_from_path(), avoiding matching
+    the same path against every template more than once.
+
+    :param tk:   Tank object
+    :param path: Path to find a template for
+    :return:     Template matching the path or None
+    """
+    key = (id(tk), path)
+    cached = _template_cache.get(key)
+    # templates may have been reloaded, or the tk id reused since
+    if cached and cached[0] is tk.templates:
+        return cached[1]
+
+    template = _fast_template_from_path(tk, path)
+    if len(_template_cache) >= _TEMPLATE_CACHE_SIZE:
+        _template_cache.clear()
+    _template_cache[key] = (tk.templates, template)
+    return template
+
+
+def _fast_template_from_path(tk, path):
+    """
+    Equivalent of tk.template_from_path() only validating the path against
+    templates which can match its extension, instead of all of them.
+
+    :param tk:   Tank object
+    :param path: Path to find a template for
+    :return:     Template matching the path or None
+    """
+    templates_by_ext, templates_any_ext = _template_index(tk)
+    ext = os.path.splitext(path)[1].lower()
+    candidates = templates_by_ext.get(ext, []) + templates_any_ext
+    matches = [template for template in candidates if template.validate(path)]
+    if len(matches) > 1:
+        # let toolkit report the ambiguity the way it usually does
+        return tk.template_from_path(path)
+    return matches[0] if matches else None
+
+
+def _template_index(tk):
+    """
+    Group the templates of the given tk by the literal extension their
+    definition ends with, built once per set of templates.
+
+    :param tk: Tank object
+    :return:   Tuple of a dictionary of lower case extensions to templates and a list
+               of templates which don't end with a literal extension
+    """
+    cached = _template_index_cache.get(id(tk))
+    if cached and cached[0] is tk.templates:
+        return cached[1]
+
+    templates_by_ext = defaultdict(list)
+    templates_any_ext = []
+    for template in tk.templates.values():
+        ext = os.path.splitext(template.definition)[1]
+        if ext and not _NON_LITERAL_EXT_RE.search(ext):
+            templates_by_ext[ext.lower()].append(template)
+        else:
+            templates_any_ext.append(template)
+
+    index = (dict(templates_by_ext), templates_any_ext)
+    _template_index_cache[id(tk)] = (tk.templates, index)
+    return index